@@ -1,16 +1,24 @@
+import collections
+import concurrent.futures
 from datetime import datetime, timezone, timedelta
-import importlib.resources
+import functools
+import heapq
 import itertools
-import json
 import logging
 import random
+import time
 
 import click
-from flask import Flask, redirect, make_response, request, render_template_string
+from flask import Flask, redirect, make_response, request
+from flask_compress import Compress
+import jinja2
+import orjson
 from pony.flask import Pony
 from pony import orm
 from pony.orm import select
 
+from psycopg2.extras import execute_values
+
 from .discovery import Guesser
 from .inventory import Inventory
 from .pypi_simple import PyPISimple
@@ -19,13 +27,27 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config.from_object('catfind.config')
+# Multi-entry listings for popular names run to hundreds of rows of
+# HTML/JSON; negotiate gzip/brotli on the way out.
+Compress(app)
+
+# Our templates live at the package root, not templates/. Teach the Jinja env
+# to find them there, and persist the compiled bytecode so even fresh
+# processes skip the parse+compile step.
+app.jinja_env.loader = jinja2.ChoiceLoader([
+    app.jinja_env.loader,
+    jinja2.PackageLoader(__name__, '.'),
+])
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 
 db = orm.Database()
 
 
-def render_template(pkg, resource, **context):
-    txt = importlib.resources.read_text(pkg, resource)
-    return render_template_string(txt, **context)
+def render_template(resource, **context):
+    # get_template() hits the env's in-process template cache after the first
+    # call, and the bytecode cache before that.
+    app.update_template_context(context)
+    return app.jinja_env.get_template(resource).render(context)
 
 
 # Current schema management: lol
@@ -36,21 +58,24 @@ def render_template(pkg, resource, **context):
 class Entry(db.Entity):
     id = orm.PrimaryKey(int, auto=True)
     domain = orm.Required(str)
-    name = orm.Required(str)
+    name = orm.Required(str, index=True)  # The wildcard-domain lookup
     dispname = orm.Required(str)
     role = orm.Required(str)
     url = orm.Required(str)
     project = orm.Required('Project')
     last_indexed = orm.Required(datetime)
     orm.composite_index(domain, name)  # Primary lookup
+    orm.composite_key(project, domain, role, name)  # index()'s dedup key
     first_seen = orm.Required(datetime, sql_default='CURRENT_TIMESTAMP')
 
-    @property
+    @functools.cached_property
     def kind(self):
+        # Rendered several times per entry per response; build the string once
         return f"{self.domain}:{self.role}"
 
-    @property
+    @functools.cached_property
     def display_name(self):
+        # Same deal as kind: read repeatedly per response, never changes
         return self.name if self.dispname == '-' else self.dispname
 
     def __str__(self):
@@ -80,77 +105,125 @@ Pony(app)
 
 @app.route("/")
 def homepage():
-    return render_template(__name__, 'homepage.html')
+    return render_template('homepage.html')
 
 
 if app.config['DEBUG']:
+    # The project table only changes when an indexing pass runs, so most hits
+    # can be served straight from RAM. Staleness is bounded by the TTL.
+    PROJECTS_TTL = 60  # seconds
+    _projects_cache = None, 0.0
+
     @app.route("/!projects")
     def projects():
-        return {'projects': [
-            {
-                'url': proj.inv_url,
-                'name': proj.name,
-                'version': proj.version,
-                'last_indexed':
-                    None if proj.last_indexed is None else proj.last_indexed.isoformat(),
-            }
-            for proj in select(i for i in Project)
-        ]}
+        global _projects_cache
+        payload, expires = _projects_cache
+        if payload is None or time.monotonic() >= expires:
+            # Tuple select: this is read-only, so skip entity hydration and
+            # identity-map bookkeeping
+            rows = select(
+                (p.inv_url, p.name, p.version, p.last_indexed) for p in Project
+            )
+            payload = {'projects': [
+                {
+                    'url': url,
+                    'name': pname,
+                    'version': version,
+                    'last_indexed':
+                        None if last_indexed is None else last_indexed.isoformat(),
+                }
+                for url, pname, version, last_indexed in rows
+            ]}
+            _projects_cache = payload, time.monotonic() + PROJECTS_TTL
+        return payload
+
+
+class LookupResult(collections.namedtuple('LookupResultBase', [
+    'name', 'domain', 'role', 'url', 'dispname', 'project_name', 'project_version',
+])):
+    """One row of a lookup, projected straight from SQL--no entity hydration,
+    and the project columns ride along on the JOIN instead of lazy-loading
+    per row.
+    """
+
+    @property
+    def kind(self):
+        return f"{self.domain}:{self.role}"
+
+    @property
+    def display_name(self):
+        return self.name if self.dispname == '-' else self.dispname
+
+    def __str__(self):
+        return self.display_name
 
 
 @app.route("/<domain>/<path:name>")
 def lookup(domain, name):
     if domain == '*':
-        entries = select(e for e in Entry if e.name == name)[:]
+        query = select(
+            (e.name, e.domain, e.role, e.url, e.dispname, e.project.name, e.project.version)
+            for e in Entry if e.name == name)
     else:
-        entries = select(e for e in Entry if e.name == name and e.domain == domain)[:]
-
-    if len(entries) == 0:
+        query = select(
+            (e.name, e.domain, e.role, e.url, e.dispname, e.project.name, e.project.version)
+            for e in Entry if e.name == name and e.domain == domain)
+
+    # A LIMIT 2 probe distinguishes miss/hit/many in a single round trip--one
+    # fewer than COUNT-then-fetch, and it never fetches more than two rows on
+    # the hot paths.
+    probe = query[:2]
+    if not probe:
         return "Nothing found", 404
-    elif len(entries) == 1:
-        e, = entries
-        return redirect(e.url, code=303)
+    elif len(probe) == 1:
+        return redirect(LookupResult(*probe[0]).url, code=303)
     else:
-        accepted = request.accept_mimetypes.best_match(LIST_TYPES.keys())
-        if accepted is None:
-            # Probably a previewer or something
-            accepted = 'text/html'
+        entries = [LookupResult(*row) for row in query]
+        # Most clients lead with exactly one of our types; take that directly
+        # and only pay werkzeug's full q-value negotiation for the rest.
+        accepted = request.headers.get('Accept', '').partition(',')[0].partition(';')[0].strip()
+        if accepted not in LIST_TYPES:
+            accepted = request.accept_mimetypes.best_match(ACCEPTED_TYPES)
+            if accepted is None:
+                # Probably a previewer or something
+                accepted = 'text/html'
         resp = LIST_TYPES[accepted](entries)
         resp.headers['Content-Type'] = accepted
-        return resp
+        # An ETag over the rendered body lets repeat visitors (and CDNs)
+        # get a 304 instead of the whole listing again.
+        resp.add_etag()
+        return resp.make_conditional(request)
 
 
 def list_plaintext(entries):
-    resp = make_response(
-        "\n".join(f"{e.project.name}: {e.kind}: {e.url}" for e in entries),
-        300,
-    )
-    return resp
+    # Hand werkzeug the lines and let it stream them, instead of building one
+    # big joined string on top of them. The lines themselves still have to be
+    # rendered here, while the db_session is open.
+    lines = [f"{e.project_name}: {e.kind}: {e.url}\n" for e in entries]
+    return app.response_class(lines, status=300)
 
 
 def list_html(entries):
     resp = make_response(
-        render_template('catfind', 'multientry.html', entries=entries),
+        render_template('multientry.html', entries=entries),
         300,
     )
     return resp
 
 
 def list_json(entries):
-    data = [
-        {
-            'name': e.name,
-            'type': e.kind,
-            'location': e.url,
-            'dispname': e.display_name,
-        }
-        for e in entries
-    ]
-    resp = make_response(
-        json.dumps(data),
+    return make_response(
+        orjson.dumps([
+            {
+                'name': e.name,
+                'type': e.kind,
+                'location': e.url,
+                'dispname': e.display_name,
+            }
+            for e in entries
+        ]),
         300,
     )
-    return resp
 
 
 LIST_TYPES = {
@@ -158,18 +231,56 @@ LIST_TYPES = {
     'text/html': list_html,
     'application/json': list_json,
 }
+# best_match wants a sequence; build it once instead of a dict_keys view
+# per request.
+ACCEPTED_TYPES = tuple(LIST_TYPES)
 
 
 @app.before_first_request
 def load_initial_indexes():
-    for url in app.config['INITIAL_INVENTORIES']:
-        with orm.db_session():
-            proj = Project.get(inv_url=url)
-
-            if proj is None:
+    urls = app.config['INITIAL_INVENTORIES']
+    # One session: a single SELECT for what's already known, and the inserts
+    # all flush on the same commit, instead of a transaction per URL.
+    with orm.db_session():
+        existing = set(select(p.inv_url for p in Project if p.inv_url in urls))
+        for url in urls:
+            if url not in existing:
                 logger.info("Adding initial inventory %r", url)
                 Project(inv_url=url)
-            # Let the scheduled task load the initial data
+        # Let the scheduled task load the initial data
+
+
+_UPSERT_COLUMNS = '"project", "domain", "role", "name", "url", "dispname", "last_indexed"'
+_UPSERT_CONFLICT = (
+    'ON CONFLICT ("project", "domain", "role", "name") DO UPDATE SET '
+    '"url" = excluded."url", "dispname" = excluded."dispname", '
+    '"last_indexed" = excluded."last_indexed"'
+)
+
+
+def _upsert_entries(rows):
+    """Bulk INSERT ... ON CONFLICT DO UPDATE of Entry rows.
+
+    Pony can't express an upsert, so this drops to SQL and lets the database
+    dedupe against the (project, domain, role, name) key in the same round
+    trip as the write. Both providers speak ON CONFLICT (sqlite since 3.24).
+    """
+    if not rows:
+        return
+    cursor = db.get_connection().cursor()
+    if db.provider.dialect == 'PostgreSQL':
+        # One round trip per page instead of one per row
+        execute_values(
+            cursor,
+            f'INSERT INTO "Entry" ({_UPSERT_COLUMNS}) VALUES %s {_UPSERT_CONFLICT}',
+            rows, page_size=500,
+        )
+    else:
+        cursor.executemany(
+            f'INSERT INTO "Entry" ({_UPSERT_COLUMNS}) '
+            f'VALUES (?, ?, ?, ?, ?, ?, ?) {_UPSERT_CONFLICT}',
+            rows,
+        )
 
 
 @app.cli.command('index')
@@ -198,18 +309,18 @@ def index(url):
 
     orm.commit()
 
+    last_indexed = now.replace(tzinfo=None)
+    # Last write wins on duplicate keys; ON CONFLICT rejects a batch that
+    # touches the same row twice.
+    items = {}
     for item in inv:
         domain, role = item.domain_role
-        ent = Entry.get(project=proj, domain=domain, role=role, name=item.name)
-        if ent is None:
-            ent = Entry(
-                project=proj, domain=domain, role=role, name=item.name,
-                url=item.location, dispname=item.dispname, last_indexed=now.replace(tzinfo=None))
-        else:
-            ent.url = item.location
-            ent.last_indexed = now.replace(tzinfo=None)
-            ent.dispname = item.dispname
-        orm.commit()
+        items[domain, role, item.name] = (item.location, item.dispname)
+
+    _upsert_entries([
+        (proj.id, domain, role, name, url, dispname, last_indexed)
+        for (domain, role, name), (url, dispname) in items.items()
+    ])
 
     proj.last_indexed = now
     orm.commit()
@@ -220,18 +331,50 @@ def index(url):
     orm.commit()
 
 
-def dyna_shuffle(seq: list, weights: list, k: int):
+def weighted_sample(seq: list, weights: list, k: int):
     """Kinda like random.shuffle(seq)[:k], but with weights.
 
-    Modifies both seq and weight in-place.
+    A-Res weighted reservoir sampling--one O(n log k) pass instead of
+    redrawing (and reallocating) the whole list per pick.
     """
-    for _ in range(k):
-        if not seq:
-            break
-        (i, value), = random.choices(list(enumerate(seq)), weights)
-        yield value
-        del seq[i]
-        del weights[i]
+    keyed = heapq.nlargest(k, (
+        (random.random() ** (1 / w), i)
+        for i, w in enumerate(weights)
+        if w > 0
+    ))
+    for _, i in keyed:
+        yield seq[i]
+
+
+def stream_shuffle(seq, bufsize=10_000):
+    """Approximately shuffles an iterable without materializing it.
+
+    Keeps a bounded buffer and emits a random resident once it fills, so the
+    output is randomized within a sliding window rather than globally. Good
+    enough for "don't retread the same packages in the same order".
+    """
+    buf = []
+    for item in seq:
+        buf.append(item)
+        if len(buf) >= bufsize:
+            i = random.randrange(bufsize)
+            buf[i], buf[-1] = buf[-1], buf[i]
+            yield buf.pop()
+    random.shuffle(buf)
+    yield from buf
+
+
+def bounded_map(executor, fn, seq, limit):
+    """Like executor.map, but lazy: pulls from seq only as results are
+    consumed, keeping at most limit tasks in flight.
+    """
+    pending = collections.deque()
+    for item in seq:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 @app.cli.command('auto-index')
@@ -247,23 +390,32 @@ def auto_index(ctx, number):
         now = datetime.now(timezone.utc)
         index_before = now - timedelta(days=1)
 
-        projs = list(select(
-            p for p in Project if not p.last_indexed or p.last_indexed <= index_before
-        ))
+        # Bound the candidate pool in SQL instead of materializing every due
+        # project: never-indexed ones first (they'd dominate the weights
+        # anyway), topped up with the longest-unindexed.
+        limit = max(number, 100)
+        projs = list(select(p for p in Project if not p.last_indexed)[:limit])
+        if len(projs) < limit:
+            projs += list(
+                select(p for p in Project if p.last_indexed <= index_before)
+                .order_by(Project.last_indexed)[:limit - len(projs)])
 
     if not projs:
         # No projects
         return
 
-    def time_since(val):
-        if val is None:
-            return 1e6  # idk, a lot i guess
-        else:
-            return (now - val.replace(tzinfo=timezone.utc)).total_seconds()
+    # last_indexed comes back naive (UTC); compare against a naive now so the
+    # per-row tzinfo reattachment (a datetime allocation each) goes away.
+    now_naive = now.replace(tzinfo=None)
 
     if len(projs) > number:
-        weights = [time_since(p.last_indexed) for p in projs]
-        projs = dyna_shuffle(projs, weights, number)
+        # Inline in the comprehension--no function call per row. Never-indexed
+        # projects get a huge weight (idk, a lot i guess).
+        weights = [
+            (now_naive - p.last_indexed).total_seconds() if p.last_indexed else 1e6
+            for p in projs
+        ]
+        projs = weighted_sample(projs, weights, number)
 
     for proj in projs:
         print(f"Updating {proj.name} ({proj.inv_url})")
@@ -272,14 +424,49 @@ def auto_index(ctx, number):
 
 def unique(seq):
     """Filters a sequence, producing each item just once.
+
+    Must stay lazy: callers feed this iterators that probe the network and
+    only pull as many items as they need.
     """
     seen = set()
+    seen_add = seen.add
     for item in seq:
         if item not in seen:
-            seen.add(item)
+            seen_add(item)
             yield item
 
 
+def _guess_inventories(guesser, pkg):
+    """Generates guessed inventory URLs for a PyPI package, best first.
+    """
+    # Using iterator chaining here for the unique() states.
+    # Basically, make sure unique(guesser.perform_guessing()) applies to
+    # all roots.
+    return unique(guesser.perform_guessing(unique(itertools.chain(
+        # First, just _try_ the name as an RTD site. This is so common it's
+        # got at least a 50/50 of working.
+        [f"https://{pkg}.readthedocs.io/"],
+        # Ok, dig deeper.
+        guesser.guess_for_pypi(pkg),
+    ))))
+
+
+def _add_project(url, *, pypi_pkg_name='', rtd_slug=''):
+    """Records a discovered inventory URL, if it's new.
+    """
+    with orm.db_session():
+        if not Project.get(inv_url=str(url)):
+            Project(
+                inv_url=str(url),
+                # Too noisy, can't positively identify that a given
+                # link is for this package specifically.
+                # Does act as an audit log, though, so we'll keep it
+                # for now.
+                pypi_pkg_name=pypi_pkg_name,
+                rtd_slug=rtd_slug,
+            )
+
+
 @app.cli.command('guess-pypi')
 @click.argument("pkg")
 @click.option('--add/--no-add', default=False, help="Automatically add to the app")
@@ -290,30 +477,11 @@ def guess_pypi(pkg, add, all, quiet):
     Given a PyPI package name, guess its object inventory
     """
     with Guesser() as guesser:
-        # Using iterator chaining here for the unique() states.
-        # Basically, make sure unique(guesser.perform_guessing()) applies to
-        # all roots.
-        for url in unique(guesser.perform_guessing(unique(itertools.chain(
-            # First, just _try_ the name as an RTD site. This is so common it's
-            # got at least a 50/50 of working.
-            [f"https://{pkg}.readthedocs.io/"],
-            # Ok, dig deeper.
-            guesser.guess_for_pypi(pkg),
-        )))):
+        for url in _guess_inventories(guesser, pkg):
             if not quiet:
                 click.echo(url)
             if add:
-                with orm.db_session():
-                    if not Project.get(inv_url=str(url)):
-                        Project(
-                            inv_url=str(url),
-                            # Too noisy, can't positively identify that a given
-                            # link is for this package specifically.
-                            # Does act as an audit log, though, so we'll keep it
-                            # for now.
-                            pypi_pkg_name=pkg,
-                            rtd_slug=guesser.rtd_slug(url) or '',
-                        )
+                _add_project(url, pypi_pkg_name=pkg, rtd_slug=guesser.rtd_slug(url) or '')
             # Since this in priority order, skip others
             if not all:
                 break
@@ -338,23 +506,32 @@ def guess_rtd(slug, add, quiet):
 
 
 @app.cli.command('crawl-pypi')
-@click.pass_context
-def crawl_pypi(ctx):
+@click.option('-j', '--jobs', type=int, default=8, help="Number of concurrent probes")
+def crawl_pypi(jobs):
     """
     Attempt to index all of PyPI
     """
-    click.echo("Loading package list...")
-    with PyPISimple() as pypi:
-        names = list(pypi.stream_project_names())
-
-    # Shuffle the names so that repeated failures don't keep retreading over the
-    # same packages.
-    # Unfortunately means we have to preload the entire package list.
-    random.shuffle(names)
+    def probe(name):
+        # Worker threads don't inherit the CLI's app context
+        with app.app_context(), Guesser() as guesser:
+            for url in _guess_inventories(guesser, name):
+                _add_project(
+                    url, pypi_pkg_name=name, rtd_slug=guesser.rtd_slug(url) or '')
+                # Since this is in priority order, skip others
+                break
+        return name
 
-    # Not too worried about rate limiting against PyPI, since this process is
+    # The probes are ~all socket wait, so threads overlap them nicely. Still
+    # not too worried about rate limiting against PyPI, since this process is
     #   S   L   O   W
-    with click.progressbar(names, item_show_func=lambda a: a) as bar:
-        for name in bar:
-            # TODO: Is there a way to do this that's nice to progress bar?
-            ctx.invoke(guess_pypi, pkg=name, add=True, quiet=True)
+    #
+    # stream_shuffle keeps failures from retreading the same packages in
+    # order, without preloading the entire ~500k-name package list, and
+    # bounded_map keeps the pool from slurping the stream eagerly.
+    with PyPISimple() as pypi, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        names = stream_shuffle(pypi.stream_project_names())
+        results = bounded_map(executor, probe, names, jobs * 2)
+        with click.progressbar(results, item_show_func=lambda a: a) as bar:
+            for _ in bar:
+                pass
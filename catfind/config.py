@@ -7,6 +7,10 @@ from urllib.parse import urlparse
 if 'DATABASE_URL' in os.environ:
     bits = urlparse(os.environ['DATABASE_URL'])
 
+    # Pony keeps its own per-thread connection cache and doesn't expose a pool
+    # size, so connection pooling happens in front of Postgres (PgBouncer et
+    # al). That just means the URL has to round-trip exactly--including the
+    # non-default port a pooler usually listens on.
     PONY = {
         'provider': bits.scheme,
         'user': bits.username,
@@ -14,6 +18,8 @@ if 'DATABASE_URL' in os.environ:
         'host': bits.hostname,
         'database': bits.path.lstrip('/'),
     }
+    if bits.port:
+        PONY['port'] = bits.port
 else:
     PONY = {
         'provider': 'sqlite',
@@ -2,7 +2,10 @@
 Tools for finding, resolving, and normalizing sphinx sites.
 """
 from __future__ import annotations
+import collections
+import concurrent.futures
 import contextlib
+import itertools
 import re
 from typing import Optional
 from urllib.parse import urlparse
@@ -89,8 +92,9 @@ class RtdClient:
             cur_url = data['next']
 
 
-# FIXME: cap size
-_CACHED_RESOLUTIONS = {}
+# LRU of url -> resolution; long crawls would otherwise grow this forever
+_CACHED_RESOLUTIONS = collections.OrderedDict()
+_CACHED_RESOLUTIONS_MAX = 4096
 
 
 class Guesser(contextlib.ExitStack):
@@ -111,13 +115,29 @@ class Guesser(contextlib.ExitStack):
         # Pretty handy bit of debugging, keep this arround
         # print(f"resolve {url=}")
 
-        if url not in _CACHED_RESOLUTIONS:
+        try:
+            _CACHED_RESOLUTIONS.move_to_end(url)
+        except KeyError:
             _CACHED_RESOLUTIONS[url] = self._real_resolve(url)
+            if len(_CACHED_RESOLUTIONS) > _CACHED_RESOLUTIONS_MAX:
+                _CACHED_RESOLUTIONS.popitem(last=False)
         return _CACHED_RESOLUTIONS[url]
 
+    def resolve_all(self, urls) -> list:
+        """Resolve several URLs concurrently, preserving order.
+
+        The probes are independent HEADs, so wall time is the slowest RTT
+        instead of the sum of them.
+        """
+        urls = list(urls)
+        if len(urls) <= 1:
+            return [self.resolve(url) for url in urls]
+        with concurrent.futures.ThreadPoolExecutor(min(len(urls), 8)) as executor:
+            return list(executor.map(self.resolve, urls))
+
     def _real_resolve(self, url):
         try:
-            resp = self.client.head(url, follow_redirects=True)
+            resp = self.client.head(url)
         except httpx.HTTPError:
             pass
         except httpx.InvalidURL:
@@ -183,10 +203,13 @@ class Guesser(contextlib.ExitStack):
         """
         # print(f"check_for_inventory {url=}")
         try:
-            with self.client.stream('GET', url, follow_redirects=True) as resp:
+            # Only the magic bytes matter. Ask for just those; servers that
+            # honor Range send 16 bytes, and for ones that don't, the stream
+            # still stops after the first chunk.
+            with self.client.stream('GET', url, headers={'Range': 'bytes=0-15'}) as resp:
                 if not resp.is_success:
                     return False
-                chunk = next(resp.iter_bytes())
+                chunk = next(resp.iter_bytes(), b'')
                 return chunk.startswith(b'# Sphinx')
         # The rest of the system should filter out errors, but occassionally shit happens
         except httpx.HTTPError:
@@ -198,12 +221,36 @@ class Guesser(contextlib.ExitStack):
         """Given a collection of discovered URLs, process them into a set of
         inventory URLs.
         """
-        yield from (
-            u
-            for urls in map(self.guess_url, roots)
-            for u in urls
-            if self.check_for_inventory(u)
-        )
+        # Different roots routinely funnel to the same candidate (Homepage and
+        # Documentation both redirecting to RTD, say); only GET each once.
+        seen = set()
+
+        # guess_url needs the app context (RTD token) inside worker threads
+        app = current_app._get_current_object()
+
+        def probe_root(root):
+            with app.app_context():
+                return list(self.guess_url(root))
+
+        # Keep a couple of roots in flight ahead of the consumer. roots must
+        # still be consumed lazily--callers chain live probes in and bail
+        # after the first hit--so this only speculates one root deep.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pending = collections.deque()
+            roots = iter(roots)
+            for root in itertools.islice(roots, 2):
+                pending.append(executor.submit(probe_root, root))
+            while pending:
+                urls = pending.popleft().result()
+                for root in itertools.islice(roots, 1):
+                    pending.append(executor.submit(probe_root, root))
+                for u in urls:
+                    key = str(u)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if self.check_for_inventory(u):
+                        yield u
 
     def guess_for_pypi(self, pkg: str):
         """Given a PyPI package name, guess at possible URLs.
@@ -211,20 +258,29 @@ class Guesser(contextlib.ExitStack):
         They are returned in "importance" order--earlier items are more
         prominent/declared than later ones.
         """
-        resp = self.client.get(f"https://pypi.org/pypi/{pkg}/json", follow_redirects=True)
+        resp = self.client.get(f"https://pypi.org/pypi/{pkg}/json")
         if not resp.is_success:
             # Not actually a package:
             return
         data = resp.json()
 
-        if data['info']['docs_url'] and self.resolve(data['info']['docs_url']):
+        # Fan out the existence probes for all the declared URLs at once;
+        # they're yielded below in the original priority order.
+        candidates = []
+        if data['info']['docs_url']:
+            candidates.append(data['info']['docs_url'])
+        if data['info']['project_urls']:
+            candidates += list(data['info']['project_urls'].values())
+        resolutions = dict(zip(candidates, self.resolve_all(candidates)))
+
+        if data['info']['docs_url'] and resolutions[data['info']['docs_url']]:
             yield data['info']['docs_url']
 
         if data['info']['project_urls']:
             yield from (
                 u
                 for u in data['info']['project_urls'].values()
-                if self.resolve(u)
+                if resolutions[u]
             )
 
             # Rummage through the README
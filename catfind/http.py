@@ -1,11 +1,47 @@
+import atexit
 import contextlib
+import threading
 
 from flask import current_app
 import httpx
 
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client() -> httpx.Client:
+    """Get the process-wide HTTP client, building it on first use.
+
+    One client for the life of the process means the connection pool (and its
+    warm TCP+TLS sessions) survives across requests and CLI invocations,
+    instead of being torn down with every Guesser.
+    """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                ua = current_app.config['USER_AGENT']
+                # We hit the same few hosts (pypi.org, readthedocs.io, ...)
+                # over and over; keep-alive and HTTP/2 multiplexing reuse
+                # connections instead of paying a handshake per request.
+                _shared = httpx.Client(
+                    headers={'User-Agent': ua},
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_keepalive_connections=32,
+                        max_connections=64,
+                        keepalive_expiry=30.0,
+                    ),
+                    timeout=httpx.Timeout(10.0, connect=5.0),
+                    follow_redirects=True,
+                )
+                atexit.register(_shared.close)
+    return _shared
+
 
 @contextlib.contextmanager
 def client():
-    ua = current_app.config['USER_AGENT']
-    with httpx.Client(headers={'User-Agent': ua}) as client:
-        yield client
+    # Kept as a context manager so existing with-blocks (and Guesser's
+    # ExitStack) don't care that the client is shared now; exiting no longer
+    # closes it.
+    yield shared_client()
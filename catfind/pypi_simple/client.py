@@ -55,7 +55,7 @@ class PyPISimple:
 
     def stream_project_names(
         self,
-        chunk_size: int = 65535,
+        chunk_size: int = 262144,
         timeout: Union[float, Tuple[float, float], None] = None,
     ) -> Iterator[str]:
         """
@@ -76,7 +76,8 @@ class PyPISimple:
             HTML.
 
         :param int chunk_size: how many bytes to read from the response at a
-            time
+            time.  The default favors throughput over the full index; shrink
+            it only if you bail out early and care about time-to-first-name.
         :param timeout: optional timeout to pass to the ``requests`` call
         :type timeout: Union[float, Tuple[float,float], None]
         :rtype: Iterator[str]
@@ -109,7 +109,7 @@ class LinkParser(HTMLParser):
 
 
 def parse_links_stream_response(
-    r: httpx.Response, chunk_size: int = 65535
+    r: httpx.Response, chunk_size: int = 262144
 ) -> Iterator[Link]:
     """
     .. versionadded:: 0.7.0